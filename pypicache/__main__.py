@@ -39,7 +39,11 @@ def main() -> int:
     grp.add_argument('--pypi-url', type=str, default='https://pypi.org/pypi', help='PyPi host to fetch data from')
     grp.add_argument('--frontend-url', type=str, help='frontend URL to use in user-agent header')
     grp.add_argument('--queue-batch-size', type=int, default=1000, help='number of packages to process from queue in one iteration')
+    grp.add_argument('--queue-fair-share', type=int, default=100, help='number of queue batch slots guaranteed to each queue priority class')
     grp.add_argument('--no-bootstrap', action='store_true', help='skip bootstrap process of updating all known packages')
+    grp.add_argument('--reconcile-interval', type=int, default=0, help='interval in seconds to reconcile database against full package listing')
+    grp.add_argument('--reconcile-rate', type=float, default=5.0, help='max number of projects per second scheduled for update by reconciliation')
+    grp.add_argument('--enqueue', type=str, metavar='NAME', nargs='+', default=[], help='schedule update of given project(s) with high priority and exit')
 
     grp = parser.add_argument_group('Output settings')
     grp.add_argument('--output-interval', type=int, default=600, help='interval between dump generation')
@@ -48,14 +52,56 @@ def main() -> int:
     grp.add_argument('--dump-file-name', type=str, default='pypicache.json.zst', help='dump file name (extensions controls used compression)')
     grp.add_argument('--dump-compression-level', type=int, default=5, help='dump compression level, if compression is used')
 
+    grp = parser.add_argument_group('HTTP server settings')
+    grp.add_argument('--http-host', type=str, default='127.0.0.1', help='address for built-in HTTP server to listen on')
+    grp.add_argument('--http-port', type=int, help='port for built-in HTTP server to listen on (server is disabled if not specified)')
+
+    grp = parser.add_argument_group('Profiling settings')
+    grp.add_argument('--profile', action='store_true', help='log per-phase timings and slowest projects for each iteration as JSON')
+    grp.add_argument('--profile-log', type=str, help='path to file to write profiling records to as JSON lines (default is stderr)')
+    grp.add_argument('--profile-top', type=int, default=10, help='number of slowest projects to report')
+    grp.add_argument('--profile-dump-path', type=str, help='path to directory to write cProfile dumps of sampled iterations to')
+    grp.add_argument('--profile-sample', type=int, default=0, help='write cProfile dump for every Nth iteration (requires --profile-dump-path)')
+
     args = parser.parse_args()
 
+    if args.reconcile_rate <= 0:
+        parser.error('--reconcile-rate must be positive')
+
+    if args.http_port and not args.output_path:
+        parser.error('--http-port requires --output-path')
+
+    if args.http_port and args.once_only:
+        parser.error('--http-port cannot be used with --once-only')
+
+    if (args.profile_log or args.profile_dump_path or args.profile_sample) and not args.profile:
+        parser.error('--profile-log, --profile-dump-path and --profile-sample require --profile')
+
+    if args.profile_sample and not args.profile_dump_path:
+        parser.error('--profile-sample requires --profile-dump-path')
+
+    if args.profile_dump_path and not args.profile_sample:
+        parser.error('--profile-dump-path requires --profile-sample')
+
     logging.basicConfig(
         format='%(asctime)s %(levelname)-8s %(message)s',
         level=logging.DEBUG if args.debug else logging.INFO,
     )
 
-    Worker(args).run()
+    if args.profile:
+        # profiling records are bare JSON lines
+        profile_handler = logging.FileHandler(args.profile_log) if args.profile_log else logging.StreamHandler()
+        profile_handler.setFormatter(logging.Formatter('%(message)s'))
+
+        profile_logger = logging.getLogger('pypicache.profile')
+        profile_logger.addHandler(profile_handler)
+        profile_logger.setLevel(logging.INFO)
+        profile_logger.propagate = False
+
+    if args.enqueue:
+        Worker(args).enqueue(args.enqueue)
+    else:
+        Worker(args).run()
 
     return 0
 
@@ -66,5 +66,8 @@ class PyPIClient:
 
         return projects, current_serial
 
+    def get_package_serials(self) -> dict[str, int]:
+        return cast(dict[str, int], self._xmlrpc.list_packages_with_serial())
+
     def get_last_serial(self) -> int:
         return cast(int, self._xmlrpc.changelog_last_serial())
@@ -15,20 +15,44 @@
 # You should have received a copy of the GNU General Public License
 # along with pypicache.  If not, see <http://www.gnu.org/licenses/>.
 
-from datetime import timedelta
-from typing import Any, Iterable, cast
+import hashlib
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from enum import IntEnum
+from typing import Any, Iterable, Iterator, cast
 
 import psycopg2
 
+from pypicache.profiling import Profiler
+
+
+class QueuePriority(IntEnum):
+    # lower value is served first
+    FEED = 0
+    MANUAL = 1
+    RETRY = 2
+    RECHECK = 3
+    BOOTSTRAP = 4
+    RECONCILE = 5
+
 
 class Database():
     _db: Any
+    _profiler: Profiler
 
-    def __init__(self, dsn: str) -> None:
+    def __init__(self, dsn: str, autocommit: bool = False, profiler: Profiler | None = None) -> None:
         self._db = psycopg2.connect(dsn, application_name='pypicache')
+        self._db.autocommit = autocommit
+        self._profiler = profiler if profiler is not None else Profiler()
+
+    @contextmanager
+    def _cursor(self, name: str | None = None) -> Iterator[Any]:
+        with self._profiler.phase('db'):
+            with self._db.cursor(name) as cur:
+                yield cur
 
     def init(self) -> None:
-        with self._db.cursor() as cur:
+        with self._cursor() as cur:
             cur.execute(
                 """
                 CREATE TABLE IF NOT EXISTS projects (
@@ -38,6 +62,8 @@ class Database():
                     updated timestamptz NOT NULL DEFAULT clock_timestamp(),
 
                     etag text,
+                    data_hash bytea,
+                    serial integer,
 
                     data_len integer,
                     orig_len integer
@@ -51,7 +77,17 @@ class Database():
                 CREATE TABLE IF NOT EXISTS queue (
                     id integer GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
                     name text NOT NULL,
-                    ready_time timestamptz
+                    ready_time timestamptz,
+                    priority smallint NOT NULL DEFAULT %(default_priority)s,
+                    serial integer
+                );
+
+                -- last seen serials of listed projects which could not be
+                -- stored (not found, too big), to avoid refetching them
+                -- on each reconciliation
+                CREATE TABLE IF NOT EXISTS unstored_serials (
+                    name text NOT NULL PRIMARY KEY,
+                    serial integer NOT NULL
                 );
 
                 CREATE TABLE IF NOT EXISTS statistics (
@@ -61,23 +97,41 @@ class Database():
                     num_removed integer NOT NULL DEFAULT 0,
                     num_too_big integer NOT NULL DEFAULT 0,
                     num_requests integer NOT NULL DEFAULT 0,
-                    last_serial integer NULL
+                    last_serial integer NULL,
+                    last_reconcile timestamptz NULL
                 );
 
                 INSERT INTO statistics DEFAULT VALUES
                 ON CONFLICT (key) DO NOTHING;
-                """
+
+                ALTER TABLE projects ADD COLUMN IF NOT EXISTS data_hash bytea;
+                ALTER TABLE projects ADD COLUMN IF NOT EXISTS serial integer;
+                ALTER TABLE statistics ADD COLUMN IF NOT EXISTS last_reconcile timestamptz NULL;
+                ALTER TABLE queue ADD COLUMN IF NOT EXISTS priority smallint NOT NULL DEFAULT %(default_priority)s;
+                ALTER TABLE queue ADD COLUMN IF NOT EXISTS serial integer;
+
+                CREATE INDEX IF NOT EXISTS queue_priority_id_idx ON queue(priority, id);
+                CREATE INDEX IF NOT EXISTS queue_name_idx ON queue(name);
+                CREATE INDEX IF NOT EXISTS projects_normalized_name_idx ON projects((lower(regexp_replace(name, '[-_.]+', '-', 'g'))));
+                """,
+                {
+                    'default_priority': int(QueuePriority.BOOTSTRAP),
+                }
             )
 
-    def update_project(self, name: str, data: str, orig_len: int, etag: str | None) -> bool:
-        with self._db.cursor() as cur:
+    def update_project(self, name: str, data: str, orig_len: int, etag: str | None, serial: int | None = None) -> bool:
+        with self._cursor() as cur:
             cur.execute(
                 """
-                WITH metadata_update AS (
+                WITH old_metadata AS (
+                    SELECT data_hash FROM projects WHERE name = %(name)s
+                ), metadata_update AS (
                     INSERT INTO projects (
                         name,
                         updated,
                         etag,
+                        data_hash,
+                        serial,
                         data_len,
                         orig_len
                     )
@@ -85,19 +139,30 @@ class Database():
                         %(name)s,
                         clock_timestamp(),
                         %(etag)s,
+                        %(data_hash)s,
+                        %(serial)s,
                         %(data_len)s,
                         %(orig_len)s
                     )
                     ON CONFLICT (name)
                     DO UPDATE SET
-                        updated = clock_timestamp(),
+                        updated = CASE
+                            WHEN projects.data_hash IS DISTINCT FROM EXCLUDED.data_hash THEN clock_timestamp()
+                            ELSE projects.updated
+                        END,
                         etag = EXCLUDED.etag,
+                        data_hash = EXCLUDED.data_hash,
+                        serial = coalesce(EXCLUDED.serial, projects.serial),
                         data_len = EXCLUDED.data_len,
                         orig_len = EXCLUDED.orig_len
                     WHERE
-                        projects.etag IS DISTINCT FROM EXCLUDED.etag
+                        projects.etag IS DISTINCT FROM EXCLUDED.etag OR
+                        projects.data_hash IS DISTINCT FROM EXCLUDED.data_hash OR
+                        projects.serial IS DISTINCT FROM coalesce(EXCLUDED.serial, projects.serial)
                     RETURNING name
                 ), data_update AS (
+                    -- only touch (large, TOASTed) data if its content
+                    -- actually changed; etag changes alone are cheap
                     INSERT INTO projects_data (
                         name,
                         data
@@ -106,16 +171,22 @@ class Database():
                         name,
                         %(data)s
                     FROM metadata_update
+                    WHERE NOT EXISTS (
+                        SELECT * FROM old_metadata WHERE data_hash = %(data_hash)s
+                    )
                     ON CONFLICT (name)
                     DO UPDATE SET
                         data = EXCLUDED.data
+                    RETURNING name
                 )
-                SELECT 1 FROM metadata_update
+                SELECT 1 FROM data_update
                 """,
                 {
                     'name': name,
                     'data': data,
                     'etag': etag,
+                    'data_hash': hashlib.sha256(data.encode('utf-8')).digest(),
+                    'serial': serial,
                     'data_len': len(data),
                     'orig_len': orig_len,
                 }
@@ -126,7 +197,7 @@ class Database():
             return bool(row and row[0])
 
     def remove_project(self, name: str) -> bool:
-        with self._db.cursor() as cur:
+        with self._cursor() as cur:
             cur.execute(
                 """
                 DELETE FROM projects WHERE name = %(name)s RETURNING 1
@@ -140,71 +211,214 @@ class Database():
 
             return bool(row and row[0])
 
+    def get_project(self, name: str) -> tuple[str, bytes | None] | None:
+        # lookup by PEP 503 normalized name
+        with self._cursor() as cur:
+            cur.execute(
+                """
+                SELECT
+                    data,
+                    data_hash
+                FROM projects
+                INNER JOIN projects_data USING (name)
+                WHERE lower(regexp_replace(projects.name, '[-_.]+', '-', 'g')) = lower(regexp_replace(%(name)s, '[-_.]+', '-', 'g'))
+                ORDER BY updated DESC
+                LIMIT 1
+                """,
+                {
+                    'name': name
+                }
+            )
+
+            row = cur.fetchone()
+
+            return (row[0], bytes(row[1]) if row[1] is not None else None) if row else None
+
     def get_etag(self, name: str) -> str | None:
-        with self._db.cursor() as cur:
+        with self._cursor() as cur:
             cur.execute('SELECT etag FROM projects WHERE name = %(name)s', {'name': name})
 
             row = cur.fetchone()
 
             return row[0] if row else None
 
+    def set_project_serial(self, name: str, serial: int) -> None:
+        with self._cursor() as cur:
+            cur.execute(
+                """
+                UPDATE projects
+                SET serial = %(serial)s
+                WHERE name = %(name)s AND serial IS DISTINCT FROM %(serial)s
+                """,
+                {
+                    'name': name,
+                    'serial': serial,
+                }
+            )
+
+    def get_project_serials(self) -> dict[str, int | None]:
+        with self._cursor('get_project_serials') as cur:
+            cur.execute('SELECT name, serial FROM projects')
+
+            return dict(cur)
+
+    def get_unstored_serials(self) -> dict[str, int]:
+        with self._cursor('get_unstored_serials') as cur:
+            cur.execute('SELECT name, serial FROM unstored_serials')
+
+            return dict(cur)
+
+    def set_unstored_serial(self, name: str, serial: int) -> None:
+        with self._cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO unstored_serials (
+                    name,
+                    serial
+                )
+                VALUES (
+                    %(name)s,
+                    %(serial)s
+                )
+                ON CONFLICT (name)
+                DO UPDATE SET
+                    serial = EXCLUDED.serial
+                """,
+                {
+                    'name': name,
+                    'serial': serial,
+                }
+            )
+
+    def remove_unstored_serials(self, names: Iterable[str]) -> None:
+        with self._cursor() as cur:
+            cur.execute(
+                """
+                DELETE FROM unstored_serials WHERE name = ANY(%(names)s)
+                """,
+                {
+                    'names': list(names),
+                }
+            )
+
     def iter_projects(self) -> Iterable[str]:
+        # not timed as db phase, as it's consumed by (and accounted as
+        # part of) output generation
         with self._db.cursor('iter_projects') as cur:
             cur.execute('SELECT data FROM projects_data')
 
             yield from (row[0] for row in cur)
 
     def get_last_serial(self) -> int | None:
-        with self._db.cursor() as cur:
+        with self._cursor() as cur:
             cur.execute('SELECT last_serial FROM statistics')
 
             return cast(int | None, next(cur)[0])
 
     def set_last_serial(self, last_serial: int) -> None:
-        with self._db.cursor() as cur:
+        with self._cursor() as cur:
             cur.execute('UPDATE statistics SET last_serial = %(last_serial)s', {'last_serial': last_serial})
 
-    def add_queue(self, name: str, postpone: timedelta | None = None) -> None:
-        with self._db.cursor() as cur:
+    def get_last_reconcile(self) -> datetime | None:
+        with self._cursor() as cur:
+            cur.execute('SELECT last_reconcile FROM statistics')
+
+            return cast(datetime | None, next(cur)[0])
+
+    def set_last_reconcile(self) -> None:
+        with self._cursor() as cur:
+            cur.execute('UPDATE statistics SET last_reconcile = clock_timestamp()')
+
+    def add_queue(self, name: str, priority: QueuePriority, postpone: timedelta | None = None, serial: int | None = None) -> None:
+        with self._cursor() as cur:
             cur.execute(
                 """
                 INSERT INTO queue(
                     name,
-                    ready_time
+                    ready_time,
+                    priority,
+                    serial
                 )
                 VALUES(
                     %(name)s,
-                    clock_timestamp() + %(postpone)s
+                    clock_timestamp() + %(postpone)s,
+                    %(priority)s,
+                    %(serial)s
                 )
                 """,
                 {
                     'name': name,
-                    'postpone': postpone
+                    'postpone': postpone,
+                    'priority': int(priority),
+                    'serial': serial,
                 }
             )
 
-    def remove_queue(self, id_: int) -> None:
-        with self._db.cursor() as cur:
-            cur.execute('DELETE FROM queue WHERE id = %(id)s', {'id': id_})
+    def remove_queue(self, name: str) -> None:
+        # postponed entries (rechecks, retries) are preserved
+        with self._cursor() as cur:
+            cur.execute(
+                """
+                DELETE FROM queue
+                WHERE name = %(name)s AND (ready_time IS NULL OR ready_time < clock_timestamp())
+                """,
+                {
+                    'name': name
+                }
+            )
 
-    def get_queue(self, limit: int) -> list[tuple[int, str]]:
-        with self._db.cursor() as cur:
+    def get_queued_names(self) -> set[str]:
+        with self._cursor('get_queued_names') as cur:
+            cur.execute('SELECT DISTINCT name FROM queue')
+
+            return set(row[0] for row in cur)
+
+    def get_queue(self, limit: int, fair_share: int = 0) -> list[tuple[str, int | None]]:
+        # Entries are served in priority order, but each priority class
+        # is guaranteed up to fair_share slots in the batch, so e.g. a
+        # large bootstrap cannot starve rechecks and vice versa
+        with self._cursor() as cur:
             cur.execute(
                 """
-                SELECT id, name FROM queue WHERE ready_time < clock_timestamp()
-                UNION ALL
-                SELECT id, name FROM queue WHERE ready_time IS NULL
+                SELECT
+                    name,
+                    serial
+                FROM (
+                    SELECT
+                        ready.id,
+                        ready.name,
+                        ready.serial,
+                        ready.priority,
+                        row_number() OVER (PARTITION BY ready.priority ORDER BY ready.id) AS rank
+                    FROM unnest(%(priorities)s::smallint[]) AS priorities(priority)
+                    CROSS JOIN LATERAL (
+                        SELECT
+                            id,
+                            name,
+                            serial,
+                            priority
+                        FROM queue
+                        WHERE
+                            queue.priority = priorities.priority AND
+                            (ready_time IS NULL OR ready_time < clock_timestamp())
+                        ORDER BY id
+                        LIMIT %(limit)s
+                    ) AS ready
+                ) AS candidates
+                ORDER BY rank > %(fair_share)s, priority, id
                 LIMIT %(limit)s
                 """,
                 {
-                    'limit': limit
+                    'priorities': [int(priority) for priority in QueuePriority],
+                    'limit': limit,
+                    'fair_share': fair_share,
                 }
             )
 
             return list(cur)
 
     def update_statistics(self, num_added: int = 0, num_changed: int = 0, num_removed: int = 0, num_too_big: int = 0, num_requests: int = 0) -> None:
-        with self._db.cursor() as cur:
+        with self._cursor() as cur:
             cur.execute(
                 """
                 UPDATE statistics
@@ -17,12 +17,13 @@
 
 import contextlib
 import datetime
+import hashlib
 import os
 import re
 from typing import Any, BinaryIO, Iterable
 
 
-def generate_output(src_path: str, dst_path: str, dump_file_name: str, item_iter: Iterable[str], compression_level: int = 5) -> None:
+def generate_output(src_path: str, dst_path: str, dump_file_name: str, item_iter: Iterable[str], compression_level: int = 5) -> str:
     if not os.path.exists(dst_path):
         os.mkdir(dst_path)
 
@@ -33,7 +34,7 @@ def generate_output(src_path: str, dst_path: str, dump_file_name: str, item_iter
     html_outpath = os.path.join(dst_path, 'index.html')
     css_outpath = os.path.join(dst_path, 'style.css')
 
-    num_packages = _generate_dump(dump_outpath, item_iter, compression_level)
+    num_packages, dump_digest = _generate_dump(dump_outpath, item_iter, compression_level)
     dump_size = os.stat(dump_outpath).st_size
 
     template_vars = {
@@ -46,6 +47,8 @@ def generate_output(src_path: str, dst_path: str, dump_file_name: str, item_iter
     _copy_template(html_inpath, html_outpath, template_vars)
     _copy_template(css_inpath, css_outpath)
 
+    return dump_digest
+
 
 def _copy_template(src_path: str, dst_path: str, template_vars: dict[str, Any] = {}) -> None:
     def template_subst(match: re.Match[str]) -> str:
@@ -67,7 +70,17 @@ def _copy_template(src_path: str, dst_path: str, template_vars: dict[str, Any] =
     os.replace(tmppath, dst_path)
 
 
-def _generate_dump(path: str, item_iter: Iterable[str], compression_level: int = 5) -> int:
+def _file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+
+    with open(path, 'rb') as fd:
+        while chunk := fd.read(1024 * 1024):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def _generate_dump(path: str, item_iter: Iterable[str], compression_level: int = 5) -> tuple[int, str]:
     tmppath = path + '.tmp'
     success = False
 
@@ -110,6 +123,8 @@ def _generate_dump(path: str, item_iter: Iterable[str], compression_level: int =
 
         success = True
 
+    digest = _file_digest(tmppath)
+
     os.replace(tmppath, path)
 
-    return num_records
+    return num_records, digest
@@ -0,0 +1,142 @@
+# Copyright (C) 2026 Dmitry Marakasov <amdmi3@amdmi3.ru>
+#
+# This file is part of pypicache
+#
+# pypicache is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pypicache is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pypicache.  If not, see <http://www.gnu.org/licenses/>.
+
+import cProfile
+import json
+import logging
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, Iterator
+
+# per-project phases which are accounted as fetching, the rest
+# are accounted as processing
+_FETCH_PHASES = {'fetch'}
+
+
+class Profiler:
+    _enabled: bool
+    _top: int
+    _dump_path: str | None
+    _sample: int
+
+    _iteration: int
+    _current_project: str | None
+    _phases: defaultdict[str, float]
+    _projects: defaultdict[str, defaultdict[str, float]]
+
+    def __init__(self, enabled: bool = False, top: int = 10, dump_path: str | None = None, sample: int = 0) -> None:
+        self._enabled = enabled
+        self._top = top
+        self._dump_path = dump_path
+        self._sample = sample
+
+        self._iteration = 0
+        self._current_project = None
+        self._phases = defaultdict(float)
+        self._projects = defaultdict(lambda: defaultdict(float))
+
+    @contextmanager
+    def project(self, name: str) -> Iterator[None]:
+        # phases inside are also accounted to the given project
+        if not self._enabled:
+            yield
+            return
+
+        self._current_project = name
+        try:
+            yield
+        finally:
+            self._current_project = None
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        if not self._enabled:
+            yield
+            return
+
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            self._phases[name] += elapsed
+            if self._current_project is not None:
+                self._projects[self._current_project][name] += elapsed
+
+    @contextmanager
+    def iteration(self) -> Iterator[None]:
+        if not self._enabled:
+            yield
+            return
+
+        self._iteration += 1
+        self._phases.clear()
+        self._projects.clear()
+
+        profile = None
+        if self._dump_path is not None and self._sample and self._iteration % self._sample == 0:
+            profile = cProfile.Profile()
+
+        start = time.monotonic()
+        try:
+            if profile is not None:
+                profile.enable()
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            self._report(time.monotonic() - start, self._dump(profile) if profile is not None else None)
+
+    def _dump(self, profile: cProfile.Profile) -> str:
+        assert self._dump_path is not None
+
+        if not os.path.exists(self._dump_path):
+            os.mkdir(self._dump_path)
+
+        path = os.path.join(self._dump_path, f'iteration-{self._iteration}-{int(time.time())}.prof')
+        profile.dump_stats(path)
+
+        return path
+
+    def _slowest(self, phases: set[str], exclude: bool = False) -> list[dict[str, Any]]:
+        def project_time(project_phases: dict[str, float]) -> float:
+            return sum(elapsed for phase, elapsed in project_phases.items() if (phase in phases) != exclude)
+
+        times = ((name, project_time(project_phases)) for name, project_phases in self._projects.items())
+
+        return [
+            {'name': name, 'time': round(elapsed, 6)}
+            for name, elapsed in sorted(times, key=lambda item: item[1], reverse=True)[:self._top]
+            if elapsed > 0
+        ]
+
+    def _report(self, total: float, dump: str | None) -> None:
+        record = {
+            'iteration': self._iteration,
+            'total': round(total, 6),
+            'phases': {phase: round(elapsed, 6) for phase, elapsed in sorted(self._phases.items())},
+            'projects': len(self._projects),
+            'slowest_fetch': self._slowest(_FETCH_PHASES),
+            'slowest_processing': self._slowest(_FETCH_PHASES, exclude=True),
+        }
+
+        if dump is not None:
+            record['cprofile_dump'] = dump
+
+        logging.getLogger('pypicache.profile').info(json.dumps(record, separators=(',', ':')))
@@ -0,0 +1,370 @@
+# Copyright (C) 2026 Dmitry Marakasov <amdmi3@amdmi3.ru>
+#
+# This file is part of pypicache
+#
+# pypicache is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pypicache is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pypicache.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+import urllib.parse
+from email.utils import formatdate
+from typing import BinaryIO
+
+from pypicache.database import Database
+
+_READ_TIMEOUT = 30
+_MAX_HEADERS = 100
+_HASH_CHUNK_SIZE = 1024 * 1024
+
+_CONTENT_TYPES = {
+    '.html': 'text/html; charset=utf-8',
+    '.css': 'text/css; charset=utf-8',
+    '.json': 'application/json',
+    '.zst': 'application/zstd',
+    '.gz': 'application/gzip',
+}
+
+# preferred first; these are not produced by output generation (with
+# the exception of compressed dump), but are picked up if placed
+# into output directory
+_PRECOMPRESSED_VARIANTS = [
+    ('zstd', '.zst'),
+    ('gzip', '.gz'),
+]
+
+_STATUS_REASONS = {
+    200: 'OK',
+    206: 'Partial Content',
+    304: 'Not Modified',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    416: 'Range Not Satisfiable',
+    500: 'Internal Server Error',
+}
+
+
+class _BadRequest(Exception):
+    pass
+
+
+def _parse_accept_encoding(header: str | None) -> set[str]:
+    encodings = set()
+
+    for item in (header or '').split(','):
+        encoding, *params = (part.strip() for part in item.split(';'))
+
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+
+        if encoding and quality > 0:
+            encodings.add(encoding.lower())
+
+    return encodings
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    # If-None-Match uses weak comparison
+    return any(
+        tag == '*' or tag.removeprefix('W/') == etag
+        for tag in (tag.strip() for tag in header.split(','))
+    )
+
+
+def _parse_range(header: str, size: int) -> tuple[int, int] | None:
+    """Parse Range header into (offset, count).
+
+    Returns None if the header should be ignored (unsupported unit or
+    multiple ranges), raises ValueError if the range is not satisfiable.
+    """
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+
+    first, sep, last = spec.strip().partition('-')
+    if not sep or not (first + last).isdecimal():
+        return None
+
+    if not first:
+        # suffix range
+        count = min(int(last), size)
+        if count == 0:
+            raise ValueError('empty suffix range')
+        return size - count, count
+
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+
+    if start >= size or end < start:
+        raise ValueError('range not satisfiable')
+
+    return start, end - start + 1
+
+
+class HTTPServer:
+    _root: str
+    _db: Database
+    _etag_cache: dict[str, tuple[tuple[int, int, int], str]]
+    _etag_lock: threading.Lock
+    _loop: asyncio.AbstractEventLoop | None
+    _server: asyncio.AbstractServer | None
+
+    def __init__(self, root: str, dsn: str) -> None:
+        self._root = root
+        self._db = Database(dsn=dsn, autocommit=True)
+        self._etag_cache = {}
+        self._etag_lock = threading.Lock()
+        self._loop = None
+        self._server = None
+
+    def set_file_digest(self, filename: str, digest: str) -> None:
+        # lets output generation supply known digests, so large files
+        # (the dump) need not be hashed on request path
+        path = os.path.join(self._root, filename)
+        st = os.stat(path)
+
+        with self._etag_lock:
+            self._etag_cache[path] = ((st.st_ino, st.st_mtime_ns, st.st_size), f'"{digest}"')
+
+    def start(self, host: str, port: int) -> None:
+        self._loop = asyncio.new_event_loop()
+
+        threading.Thread(target=self._loop.run_forever, name='http-server', daemon=True).start()
+
+        self._server = asyncio.run_coroutine_threadsafe(
+            asyncio.start_server(self._handle_connection, host, port),
+            self._loop
+        ).result()
+
+        logging.info(f'http server listening on {host}:{port}')
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            try:
+                method, target, headers = await asyncio.wait_for(self._read_request(reader), _READ_TIMEOUT)
+            except _BadRequest:
+                await self._write_simple(writer, 400)
+                return
+
+            if method not in ('GET', 'HEAD'):
+                await self._write_simple(writer, 405, {'Allow': 'GET, HEAD'})
+                return
+
+            path = urllib.parse.unquote(urllib.parse.urlsplit(target).path)
+
+            if path.startswith('/project/'):
+                await self._serve_project(writer, method, path.removeprefix('/project/'), headers)
+            else:
+                await self._serve_file(writer, method, path.removeprefix('/') or 'index.html', headers)
+        except (ConnectionError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+            pass
+        except Exception:
+            logging.exception('http request processing failed')
+            try:
+                await self._write_simple(writer, 500)
+            except ConnectionError:
+                pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def _read_line(self, reader: asyncio.StreamReader) -> str:
+        try:
+            return (await reader.readline()).decode('latin-1')
+        except (ValueError, asyncio.LimitOverrunError):
+            # line exceeds stream buffer limit
+            raise _BadRequest()
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> tuple[str, str, dict[str, str]]:
+        try:
+            method, target, version = (await self._read_line(reader)).split()
+        except ValueError:
+            raise _BadRequest()
+
+        if not version.startswith('HTTP/1.'):
+            raise _BadRequest()
+
+        headers: dict[str, str] = {}
+
+        for _ in range(_MAX_HEADERS):
+            line = await self._read_line(reader)
+            if line in ('\r\n', '\n', ''):
+                return method, target, headers
+
+            key, sep, value = line.partition(':')
+            if not sep:
+                raise _BadRequest()
+
+            headers[key.strip().lower()] = value.strip()
+
+        raise _BadRequest()
+
+    async def _write_head(self, writer: asyncio.StreamWriter, status: int, headers: dict[str, str]) -> None:
+        lines = [f'HTTP/1.1 {status} {_STATUS_REASONS[status]}']
+        lines.append(f'Date: {formatdate(usegmt=True)}')
+        lines.append('Server: pypicache')
+        lines.append('Connection: close')
+        lines.extend(f'{key}: {value}' for key, value in headers.items())
+
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        await writer.drain()
+
+    async def _write_simple(self, writer: asyncio.StreamWriter, status: int, headers: dict[str, str] = {}) -> None:
+        body = f'{status} {_STATUS_REASONS[status]}\n'.encode('utf-8')
+
+        await self._write_head(writer, status, headers | {'Content-Type': 'text/plain; charset=utf-8', 'Content-Length': str(len(body))})
+        writer.write(body)
+        await writer.drain()
+
+    async def _serve_project(self, writer: asyncio.StreamWriter, method: str, name: str, headers: dict[str, str]) -> None:
+        project = await asyncio.to_thread(self._db.get_project, name)
+
+        if project is None:
+            await self._write_simple(writer, 404)
+            return
+
+        data, data_hash = project
+        body = data.encode('utf-8')
+        etag = '"' + (data_hash or hashlib.sha256(body).digest()).hex() + '"'
+
+        if (if_none_match := headers.get('if-none-match')) is not None and _etag_matches(if_none_match, etag):
+            await self._write_head(writer, 304, {'ETag': etag})
+            return
+
+        await self._write_head(writer, 200, {
+            'Content-Type': 'application/json',
+            'Content-Length': str(len(body)),
+            'ETag': etag,
+            'Cache-Control': 'no-cache',
+        })
+
+        if method == 'GET':
+            writer.write(body)
+            await writer.drain()
+
+    def _select_variant(self, filename: str, headers: dict[str, str]) -> tuple[str, str | None] | None:
+        path = os.path.join(self._root, filename)
+        accepted = _parse_accept_encoding(headers.get('accept-encoding'))
+
+        for encoding, suffix in _PRECOMPRESSED_VARIANTS:
+            if encoding in accepted and os.path.isfile(path + suffix):
+                return path + suffix, encoding
+
+        if os.path.isfile(path):
+            return path, None
+
+        return None
+
+    def _open_variant(self, filename: str, headers: dict[str, str]) -> tuple[BinaryIO, str | None, os.stat_result, str] | None:
+        # does blocking filesystem calls, to be run in a thread
+        if (variant := self._select_variant(filename, headers)) is None:
+            return None
+
+        path, encoding = variant
+
+        try:
+            fd = open(path, 'rb')
+        except FileNotFoundError:
+            # replaced by output generation meanwhile
+            return None
+
+        try:
+            st = os.fstat(fd.fileno())
+            return fd, encoding, st, self._get_file_etag(path, fd, st)
+        except:
+            fd.close()
+            raise
+
+    def _get_file_etag(self, path: str, fd: BinaryIO, st: os.stat_result) -> str:
+        key = (st.st_ino, st.st_mtime_ns, st.st_size)
+
+        # serialized, so concurrent requests for a file not yet known
+        # hash it only once
+        with self._etag_lock:
+            if (cached := self._etag_cache.get(path)) is not None and cached[0] == key:
+                return cached[1]
+
+            digest = hashlib.sha256()
+            offset = 0
+            while chunk := os.pread(fd.fileno(), _HASH_CHUNK_SIZE, offset):
+                digest.update(chunk)
+                offset += len(chunk)
+
+            etag = f'"{digest.hexdigest()}"'
+            self._etag_cache[path] = (key, etag)
+
+            return etag
+
+    async def _serve_file(self, writer: asyncio.StreamWriter, method: str, filename: str, headers: dict[str, str]) -> None:
+        # only plain files from the output directory; skip hidden and
+        # temporary files which are being written
+        if '/' in filename or filename.startswith('.') or filename.endswith('.tmp'):
+            await self._write_simple(writer, 404)
+            return
+
+        if (variant := await asyncio.to_thread(self._open_variant, filename, headers)) is None:
+            await self._write_simple(writer, 404)
+            return
+
+        fd, encoding, st, etag = variant
+
+        with fd:
+            response_headers = {
+                'Content-Type': _CONTENT_TYPES.get(os.path.splitext(filename)[1], 'application/octet-stream'),
+                'ETag': etag,
+                'Last-Modified': formatdate(st.st_mtime, usegmt=True),
+                'Accept-Ranges': 'bytes',
+                'Vary': 'Accept-Encoding',
+                'Cache-Control': 'no-cache',
+            }
+
+            if encoding is not None:
+                response_headers['Content-Encoding'] = encoding
+
+            if (if_none_match := headers.get('if-none-match')) is not None and _etag_matches(if_none_match, etag):
+                await self._write_head(writer, 304, response_headers)
+                return
+
+            status = 200
+            offset, count = 0, st.st_size
+
+            # If-Range requires strong comparison
+            if (range_header := headers.get('range')) is not None and headers.get('if-range', etag) == etag:
+                try:
+                    if (byte_range := _parse_range(range_header, st.st_size)) is not None:
+                        status = 206
+                        offset, count = byte_range
+                        response_headers['Content-Range'] = f'bytes {offset}-{offset + count - 1}/{st.st_size}'
+                except ValueError:
+                    await self._write_simple(writer, 416, {'Content-Range': f'bytes */{st.st_size}'})
+                    return
+
+            response_headers['Content-Length'] = str(count)
+
+            await self._write_head(writer, status, response_headers)
+
+            if method == 'GET' and count > 0:
+                await asyncio.get_running_loop().sendfile(writer.transport, fd, offset, count)
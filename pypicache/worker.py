@@ -19,15 +19,22 @@ import argparse
 import json
 import logging
 import time
-from datetime import timedelta
+from datetime import datetime, timedelta, timezone
 
 import requests
 
 from pypicache import __version__
 from pypicache.api_client import PyPIClient
 from pypicache.cleanup import prepare_project_data
-from pypicache.database import Database
+from pypicache.database import Database, QueuePriority
 from pypicache.output import generate_output
+from pypicache.profiling import Profiler
+from pypicache.server import HTTPServer
+
+
+def _get_serial(res: requests.Response, default: int | None = None) -> int | None:
+    serial = res.headers.get('x-pypi-last-serial')
+    return int(serial) if serial is not None and serial.isdecimal() else default
 
 
 class Worker:
@@ -35,6 +42,8 @@ class Worker:
 
     _db: Database
     _pypi: PyPIClient
+    _server: HTTPServer | None
+    _profiler: Profiler
 
     def __init__(self, args: argparse.Namespace) -> None:
         ua = f'pypicache/{__version__}'
@@ -42,16 +51,26 @@ class Worker:
             ua += f' (+{args.frontend_url}'
 
         self._args = args
-        self._db = Database(dsn=args.dsn)
+        self._profiler = Profiler(enabled=args.profile, top=args.profile_top, dump_path=args.profile_dump_path, sample=args.profile_sample)
+        self._db = Database(dsn=args.dsn, profiler=self._profiler)
         self._pypi = PyPIClient(user_agent=ua, api_url=args.pypi_url, timeout=args.timeout)
+        self._server = None
 
         self._db.init()
 
-    def _update_single_project(self, name: str) -> None:
+    def enqueue(self, names: list[str]) -> None:
+        for name in names:
+            self._db.add_queue(name, QueuePriority.MANUAL)
+        self._db.commit()
+
+        logging.info(f'put {len(names)} project(s) to queue')
+
+    def _update_single_project(self, name: str, listed_serial: int | None = None) -> None:
         try:
             etag = self._db.get_etag(name)
 
-            res = self._pypi.get_project(name, etag)
+            with self._profiler.phase('fetch'):
+                res = self._pypi.get_project(name, etag)
             self._db.update_statistics(num_requests=1)
 
             # redirects are not expected to happen after https://github.com/pypa/warehouse/commit/f7f48cb7fd58e08c1f8beba3846569e074e0b297
@@ -63,19 +82,30 @@ class Worker:
                     logging.info(f'  {name}: not found, removed')
                 else:
                     logging.info(f'  {name}: not found')
+
+                if listed_serial is not None:
+                    self._db.set_unstored_serial(name, listed_serial)
             elif res.status_code == 304:
+                if (serial := _get_serial(res, listed_serial)) is not None:
+                    self._db.set_project_serial(name, serial)
                 logging.info(f'  {name}: not modified')
             elif res.status_code == 200:
                 if len(res.content) > 1024 * 1024 * 5:
                     self._db.update_statistics(num_too_big=1)
+                    if listed_serial is not None:
+                        self._db.set_unstored_serial(name, listed_serial)
                     logging.info(f'  {name}: response too big ({len(res.content)} bytes), refusing to process')
                     return
 
-                data = json.loads(res.text)
+                with self._profiler.phase('parse'):
+                    data = json.loads(res.text)
 
                 real_name = data['info']['name']
 
-                updated = self._db.update_project(real_name, prepare_project_data(data), len(res.text), res.headers.get('etag'))
+                with self._profiler.phase('prepare'):
+                    prepared_data = prepare_project_data(data)
+
+                updated = self._db.update_project(real_name, prepared_data, len(res.text), res.headers.get('etag'), _get_serial(res, listed_serial))
 
                 if real_name != name:
                     if self._db.remove_project(name):
@@ -95,88 +125,156 @@ class Worker:
             else:
                 logging.info(f'  {name} failed: bad HTTP code {res.status_code}, readding to queue')
                 if self._args.retry:
-                    self._db.add_queue(name, timedelta(seconds=self._args.retry))
+                    self._db.add_queue(name, QueuePriority.RETRY, timedelta(seconds=self._args.retry))
 
         except requests.Timeout:
             logging.info(f'  {name}: failed: timeout, readding to queue')
             if self._args.retry:
-                self._db.add_queue(name, timedelta(seconds=self._args.retry))
+                self._db.add_queue(name, QueuePriority.RETRY, timedelta(seconds=self._args.retry))
 
     def _process_changes(self) -> None:
         last_serial = self._db.get_last_serial()
 
         if last_serial is None and self._args.no_bootstrap:
             logging.warning('skipping boostrap, package database will be incomplete!')
-            last_serial = self._pypi.get_last_serial()
+            with self._profiler.phase('xmlrpc'):
+                last_serial = self._pypi.get_last_serial()
+
+            # otherwise first reconciliation would do the bootstrap anyway
+            self._db.set_last_reconcile()
         elif last_serial is None:
             logging.info('bootstrapping by scheduling updates for all projects')
             logging.info('requesting listing of all packages')
-            names, last_serial = self._pypi.get_all_packages()
+            with self._profiler.phase('xmlrpc'):
+                names, last_serial = self._pypi.get_all_packages()
 
             logging.info(f'putting {len(names)} project(s) to queue')
             for name in names:
-                self._db.add_queue(name)
+                self._db.add_queue(name, QueuePriority.BOOTSTRAP)
+
+            # bootstrap already covers everything reconciliation would
+            self._db.set_last_reconcile()
         else:
-            names, last_serial = self._pypi.get_changes(last_serial)
+            with self._profiler.phase('xmlrpc'):
+                names, last_serial = self._pypi.get_changes(last_serial)
 
-            logging.info(f'updating {len(names)} project(s) from feed')
+            logging.info(f'putting {len(names)} project(s) from feed to queue')
             for name in names:
-                self._update_single_project(name)
+                self._db.add_queue(name, QueuePriority.FEED)
                 if self._args.recheck:
-                    self._db.add_queue(name, timedelta(seconds=self._args.recheck))
+                    self._db.add_queue(name, QueuePriority.RECHECK, timedelta(seconds=self._args.recheck))
 
         self._db.set_last_serial(last_serial)
 
+    def _process_reconcile(self) -> None:
+        last_reconcile = self._db.get_last_reconcile()
+
+        if last_reconcile is not None and datetime.now(timezone.utc) - last_reconcile < timedelta(seconds=self._args.reconcile_interval):
+            return
+
+        logging.info('reconciling by requesting listing of all packages')
+        with self._profiler.phase('xmlrpc'):
+            remote_serials = self._pypi.get_package_serials()
+
+        local_serials = self._db.get_project_serials()
+        prev_unstored_serials = self._db.get_unstored_serials()
+        queued_names = self._db.get_queued_names()
+
+        # projects without serial (stored before serials were tracked)
+        # are considered outdated, they are refetched once and mostly
+        # get their serial from 304 response
+        outdated = set(
+            name
+            for name, serial in remote_serials.items()
+            if name in local_serials and ((local_serial := local_serials[name]) is None or local_serial < serial)
+        )
+        unstored = set(
+            name
+            for name, serial in remote_serials.items()
+            if name not in local_serials and ((prev_serial := prev_unstored_serials.get(name)) is None or prev_serial < serial)
+        )
+        vanished = set(local_serials.keys()) - set(remote_serials.keys())
+        names = sorted((outdated | unstored | vanished) - queued_names)
+
+        logging.info(f'found {len(outdated)} outdated, {len(unstored)} new or unstored and {len(vanished)} vanished project(s), putting {len(names)} project(s) to queue')
+
+        # spread updates over time to keep within the rate budget; listed
+        # serial is passed along to be remembered if project cannot be stored
+        self._db.remove_unstored_serials(name for name in prev_unstored_serials if name in local_serials or name not in remote_serials)
+
+        for num, name in enumerate(names):
+            self._db.add_queue(name, QueuePriority.RECONCILE, timedelta(seconds=num / self._args.reconcile_rate), remote_serials.get(name))
+
+        self._db.set_last_reconcile()
+
     def _process_queue(self) -> None:
-        if queue := self._db.get_queue(self._args.queue_batch_size):
-            count = len(set(name for _, name in queue))
+        queue = self._db.get_queue(self._args.queue_batch_size, self._args.queue_fair_share)
 
-            logging.info(f'updating {count} project(s) from queue')
+        if queue:
+            # serials from package listing, if known
+            listed_serials: dict[str, int | None] = dict.fromkeys(name for name, _ in queue)
+            for name, serial in queue:
+                if serial is not None:
+                    listed_serials[name] = max(serial, listed_serials[name] or 0)
 
-            processed = set()
+            logging.info(f'updating {len(listed_serials)} project(s) from queue')
 
-            for id_, name in queue:
-                if name not in processed:
-                    self._update_single_project(name)
-                    processed.add(name)
-                self._db.remove_queue(id_)
+            for name, listed_serial in listed_serials.items():
+                with self._profiler.project(name):
+                    self._update_single_project(name, listed_serial)
+                    # also drops other ready entries for the same project
+                    # (e.g. bootstrap ones not included in this batch)
+                    self._db.remove_queue(name)
 
     def _generate_output(self) -> None:
         logging.info('generating output')
 
         start = time.time()
-        generate_output(
-            self._args.html_path,
-            self._args.output_path,
-            self._args.dump_file_name,
-            self._db.iter_projects(),
-            self._args.dump_compression_level
-        )
+        with self._profiler.phase('output'):
+            dump_digest = generate_output(
+                self._args.html_path,
+                self._args.output_path,
+                self._args.dump_file_name,
+                self._db.iter_projects(),
+                self._args.dump_compression_level
+            )
         end = time.time()
 
+        if self._server is not None:
+            self._server.set_file_digest(self._args.dump_file_name, dump_digest)
+
         logging.info(f'output generated in {end-start:.2f} seconds')
 
     def run(self) -> None:
         last_update = 0.0
         last_output = 0.0
 
+        if self._args.http_port:
+            self._server = HTTPServer(root=self._args.output_path, dsn=self._args.dsn)
+            self._server.start(self._args.http_host, self._args.http_port)
+
         while True:
             logging.info('iteration started')
 
-            now = time.time()
-
-            if now - last_update >= self._args.update_interval:
-                self._process_changes()
-                self._process_queue()
-                self._db.commit()
-                last_update = now
-
-            now = time.time()
-
-            if self._args.output_path and now - last_output >= self._args.output_interval:
-                self._generate_output()
-                self._db.commit()
-                last_output = now
+            with self._profiler.iteration():
+                now = time.time()
+
+                if now - last_update >= self._args.update_interval:
+                    self._process_changes()
+                    if self._args.reconcile_interval:
+                        self._process_reconcile()
+                    self._process_queue()
+                    with self._profiler.phase('commit'):
+                        self._db.commit()
+                    last_update = now
+
+                now = time.time()
+
+                if self._args.output_path and now - last_output >= self._args.output_interval:
+                    self._generate_output()
+                    with self._profiler.phase('commit'):
+                        self._db.commit()
+                    last_output = now
 
             if self._args.once_only:
                 logging.info('iteration done')